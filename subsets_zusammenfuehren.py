@@ -2,183 +2,246 @@
 
 import sys
 import os
-import struct
+import array
 import copy
-import xml.etree.ElementTree as ET
 from collections import defaultdict, namedtuple
+from operator import itemgetter
+
+try:
+    from lxml import etree as ET
+
+    # Drop comments and processing instructions like xml.etree.ElementTree does.
+    XML_PARSER = ET.XMLParser(remove_comments=True, remove_pis=True)
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+    XML_PARSER = None
 
 Subset = namedtuple("Subset", ["node", "verts", "tris"])
 
-facestruct = struct.Struct("1H1H1H")
-LSB_SEPARATOR = facestruct.pack(0, 0, 0)
+LSB_SEPARATOR = array.array("H", (0, 0, 0)).tobytes()
 XML_SEPARATOR = ET.Element("Face", {"i": "0;0;0"})
+SUBSET_KEY_IGNORED_ATTRIBS = frozenset(("MeshI", "MeshV"))
 
 
 def calc_subset_key(subset_node):
-    result = ""
-    for key, value in sorted(subset_node.attrib.items()):
-        if key in ("MeshI", "MeshV"):
-            continue
-        result += f"{key}={value},"
-    for child in subset_node:
-        if child.tag in ("Vertex", "Face"):
-            continue
-        result += f"{child.tag}=[" + calc_subset_key(child) + "]"
-    return result
+    return (
+        subset_node.tag,
+        tuple(
+            item
+            for item in sorted(subset_node.attrib.items(), key=itemgetter(0))
+            if item[0] not in SUBSET_KEY_IGNORED_ATTRIBS
+        ),
+        tuple(
+            calc_subset_key(child)
+            for child in subset_node
+            if child.tag not in ("Vertex", "Face")
+        ),
+    )
 
 
-def pack(subsets, orig_lsb_data):
+def shift_face_indexes(faceindexes, offset):
+    return memoryview(array.array("H", map(offset.__add__, faceindexes))).cast("B")
+
+
+def parse_face_nodes(face_nodes):
+    if not face_nodes:
+        return array.array("H")
+    return array.array(
+        "H", map(int, ";".join(node.attrib["i"] for node in face_nodes).split(";"))
+    )
+
+
+def format_face_indexes(faceindexes, offset):
+    face_format = "%d;%d;%d\n" * (len(faceindexes) // 3)
+    return (face_format % tuple(map(offset.__add__, faceindexes))).splitlines()
+
+
+def read_lsb_file(lsb_filename):
+    try:
+        with open(lsb_filename, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def find_lsb_separators(lsb_data, tris):
+    pos = lsb_data.find(LSB_SEPARATOR, tris.start, tris.stop)
+    while pos >= 0:
+        if (pos - tris.start) % 6 == 0:
+            yield pos
+            pos += 6
+        else:
+            pos += 1
+        pos = lsb_data.find(LSB_SEPARATOR, pos, tris.stop)
+    yield tris.stop
+
+
+def find_xml_separators(faceindexes):
+    faceindexes_iter = iter(faceindexes)
+    for face_idx, face in enumerate(
+        zip(faceindexes_iter, faceindexes_iter, faceindexes_iter)
+    ):
+        if face == (0, 0, 0):
+            yield 3 * face_idx
+    yield len(faceindexes)
+
+
+def copy_subset_node(subset_node):
+    new_node = ET.Element(subset_node.tag, dict(subset_node.attrib))
+    new_node[:] = [
+        copy.deepcopy(node)
+        for node in subset_node
+        if node.tag not in ("Vertex", "Face")
+    ]
+    return new_node
+
+
+def pack_lsb(subsets, orig_lsb_data):
     vert_idx_offset = 0
-    new_vertex_data = b"" if orig_lsb_data is not None else []
-    new_tri_data = b"" if orig_lsb_data is not None else []
-    new_lsb_data = b"" if orig_lsb_data is not None else None
+    new_vertex_data = []
+    new_tri_data = []
+    new_lsb_data = []
+    lsb_view = memoryview(orig_lsb_data)
     new_subset_nodes = []
 
     def flush():
-        nonlocal vert_idx_offset, new_vertex_data, new_tri_data, orig_lsb_data, new_lsb_data
-        if orig_lsb_data is not None:
-            new_node = copy.deepcopy(subsets[0].node)
-            new_node.attrib["MeshV"] = str(len(new_vertex_data) // 40)
-            new_node.attrib["MeshI"] = str(len(new_tri_data) // 2)
-            new_lsb_data += new_vertex_data
-            new_lsb_data += new_tri_data
-            new_vertex_data = b""
-            new_tri_data = b""
-        else:
-            new_node = ET.Element(
-                subsets[0].node.tag, copy.deepcopy(subsets[0].node.attrib)
-            )
-            new_node[:] = (
-                [
-                    copy.deepcopy(node)
-                    for node in subsets[0].node
-                    if node.tag not in ("Vertex", "Face")
-                ]
-                + new_vertex_data
-                + new_tri_data
-            )
-            new_vertex_data = []
-            new_tri_data = []
+        nonlocal vert_idx_offset, new_vertex_data, new_tri_data
+        new_node = copy.deepcopy(subsets[0].node)
+        new_node.attrib["MeshV"] = str(sum(map(len, new_vertex_data)) // 40)
+        new_node.attrib["MeshI"] = str(sum(map(len, new_tri_data)) // 2)
+        new_lsb_data.extend(new_vertex_data)
+        new_lsb_data.extend(new_tri_data)
+        new_vertex_data = []
+        new_tri_data = []
         new_subset_nodes.append(new_node)
         vert_idx_offset = 0
 
     for subset in subsets:
-        num_vertices = (
-            ((subset.verts.stop - subset.verts.start) // 40)
-            if orig_lsb_data is not None
-            else len(subset.verts)
-        )
+        num_vertices = (subset.verts.stop - subset.verts.start) // 40
         if vert_idx_offset + num_vertices >= 65536:
             flush()
         assert vert_idx_offset + num_vertices < 65536
-        new_vertex_data += (
-            orig_lsb_data[subset.verts] if orig_lsb_data is not None else subset.verts
-        )
+        new_vertex_data.append(lsb_view[subset.verts])
         if vert_idx_offset == 0:
-            new_tri_data += (
-                orig_lsb_data[subset.tris] if orig_lsb_data is not None else subset.tris
-            )
+            new_tri_data.append(lsb_view[subset.tris])
         else:
-            if orig_lsb_data is not None:
-                new_tri_data += LSB_SEPARATOR
-                for faceindexes in facestruct.iter_unpack(orig_lsb_data[subset.tris]):
-                    new_tri_data += facestruct.pack(
-                        faceindexes[0] + vert_idx_offset,
-                        faceindexes[1] + vert_idx_offset,
-                        faceindexes[2] + vert_idx_offset,
-                    )
-            else:
-                new_tri_data.append(copy.deepcopy(XML_SEPARATOR))
-                for face_node in subset.tris:
-                    faceindexes = face_node.attrib["i"].split(";")
-                    face_node.attrib["i"] = ";".join(
-                        (
-                            str(int(faceindexes[0]) + vert_idx_offset),
-                            str(int(faceindexes[1]) + vert_idx_offset),
-                            str(int(faceindexes[2]) + vert_idx_offset),
-                        )
-                    )
-                new_tri_data += subset.tris
+            new_tri_data.append(LSB_SEPARATOR)
+            new_tri_data.append(
+                shift_face_indexes(lsb_view[subset.tris].cast("H"), vert_idx_offset)
+            )
         vert_idx_offset += num_vertices
     flush()
     return (new_subset_nodes, new_lsb_data)
 
 
-def unpack(subset, orig_lsb_data):
+def pack_xml(subsets):
     vert_idx_offset = 0
+    new_vertex_data = []
+    new_tri_data = []
+    template_node = copy_subset_node(subsets[0].node)
     new_subset_nodes = []
-    if orig_lsb_data is not None:
-        new_lsb_data = b""
-        lsb_data_start = subset.tris.start
-        for lsb_data_end in range(subset.tris.start, subset.tris.stop + 6, 6):
-            if (lsb_data_end != subset.tris.stop) and (
-                orig_lsb_data[lsb_data_end : lsb_data_end + 6] != LSB_SEPARATOR
+
+    def flush():
+        nonlocal vert_idx_offset, new_vertex_data, new_tri_data
+        new_node = copy.deepcopy(template_node)
+        new_node.extend(new_vertex_data)
+        new_node.extend(new_tri_data)
+        new_vertex_data = []
+        new_tri_data = []
+        new_subset_nodes.append(new_node)
+        vert_idx_offset = 0
+
+    for subset in subsets:
+        num_vertices = len(subset.verts)
+        if vert_idx_offset + num_vertices >= 65536:
+            flush()
+        assert vert_idx_offset + num_vertices < 65536
+        new_vertex_data += subset.verts
+        if vert_idx_offset != 0:
+            new_tri_data.append(copy.deepcopy(XML_SEPARATOR))
+            for face_node, i in zip(
+                subset.tris,
+                format_face_indexes(parse_face_nodes(subset.tris), vert_idx_offset),
             ):
-                continue
-            # Determine all vertices which must be extracted.
-            facedata = list(
-                facestruct.iter_unpack(orig_lsb_data[lsb_data_start:lsb_data_end])
-            )
-            max_vertex_index = max(max(faceindexes) for faceindexes in facedata)
-            assert max_vertex_index < (subset.verts.stop - subset.verts.start)
+                face_node.attrib["i"] = i
+        new_tri_data += subset.tris
+        vert_idx_offset += num_vertices
+    flush()
+    return (new_subset_nodes, None)
+
+
+def pack(subsets, orig_lsb_data):
+    if orig_lsb_data is not None:
+        return pack_lsb(subsets, orig_lsb_data)
+    return pack_xml(subsets)
 
-            new_lsb_data += orig_lsb_data[
+
+def unpack_lsb(subset, orig_lsb_data):
+    vert_idx_offset = 0
+    new_subset_nodes = []
+    new_lsb_data = []
+    lsb_view = memoryview(orig_lsb_data)
+    faceindexes = lsb_view[subset.tris].cast("H")
+    tri_idx_start = 0
+    for lsb_data_end in find_lsb_separators(orig_lsb_data, subset.tris):
+        tri_idx_end = (lsb_data_end - subset.tris.start) // 2
+        # Determine all vertices which must be extracted.
+        facedata = faceindexes[tri_idx_start:tri_idx_end]
+        max_vertex_index = max(facedata)
+        assert max_vertex_index < (subset.verts.stop - subset.verts.start)
+
+        new_lsb_data.append(
+            lsb_view[
                 (subset.verts.start + 40 * vert_idx_offset) : (
                     subset.verts.start + 40 * (max_vertex_index + 1)
                 )
             ]
-            for faceindexes in facedata:
-                new_lsb_data += facestruct.pack(
-                    faceindexes[0] - vert_idx_offset,
-                    faceindexes[1] - vert_idx_offset,
-                    faceindexes[2] - vert_idx_offset,
-                )
+        )
+        if vert_idx_offset == 0:
+            new_lsb_data.append(
+                lsb_view[(subset.tris.start + 2 * tri_idx_start) : lsb_data_end]
+            )
+        else:
+            new_lsb_data.append(shift_face_indexes(facedata, -vert_idx_offset))
 
-            new_node = copy.deepcopy(subset.node)
-            new_node.attrib["MeshV"] = str(max_vertex_index - vert_idx_offset + 1)
-            new_node.attrib["MeshI"] = str(len(facedata) * 3)
-            new_subset_nodes.append(new_node)
+        new_node = copy.deepcopy(subset.node)
+        new_node.attrib["MeshV"] = str(max_vertex_index - vert_idx_offset + 1)
+        new_node.attrib["MeshI"] = str(len(facedata))
+        new_subset_nodes.append(new_node)
 
-            vert_idx_offset = max_vertex_index + 1
-            lsb_data_start = lsb_data_end + 6
-        return (new_subset_nodes, new_lsb_data)
-    else:
-        tri_idx_start = 0
-        for tri_idx_end in range(len(subset.tris) + 1):
-            if (tri_idx_end != len(subset.tris)) and (
-                subset.tris[tri_idx_end].attrib["i"] != "0;0;0"
-            ):
-                continue
-            # Determine all vertices which must be extracted.
-            facedata = [
-                [int(i) for i in face_node.attrib["i"].split(";")]
-                for face_node in subset.tris[tri_idx_start:tri_idx_end]
-            ]
-            max_vertex_index = max(max(faceindexes) for faceindexes in facedata)
-            assert max_vertex_index < len(subset.verts)
-
-            new_node = ET.Element(subset.node.tag, copy.deepcopy(subset.node.attrib))
-            new_node[:] = [
-                copy.deepcopy(node)
-                for node in subset.node
-                if node.tag not in ("Vertex", "Face")
-            ] + subset.verts[vert_idx_offset : max_vertex_index + 1]
-            for faceindexes in facedata:
-                ET.SubElement(
-                    new_node,
-                    "Face",
-                    {
-                        "i": ";".join(
-                            str(faceindex - vert_idx_offset)
-                            for faceindex in faceindexes
-                        )
-                    },
-                )
-            new_subset_nodes.append(new_node)
+        vert_idx_offset = max_vertex_index + 1
+        tri_idx_start = tri_idx_end + 3
+    return (new_subset_nodes, new_lsb_data)
 
-            vert_idx_offset = max_vertex_index + 1
-            tri_idx_start = tri_idx_end + 1
-        return (new_subset_nodes, None)
+
+def unpack_xml(subset):
+    vert_idx_offset = 0
+    new_subset_nodes = []
+    template_node = copy_subset_node(subset.node)
+    faceindexes = parse_face_nodes(subset.tris)
+    tri_idx_start = 0
+    for tri_idx_end in find_xml_separators(faceindexes):
+        # Determine all vertices which must be extracted.
+        facedata = faceindexes[tri_idx_start:tri_idx_end]
+        max_vertex_index = max(facedata)
+        assert max_vertex_index < len(subset.verts)
+
+        new_node = copy.deepcopy(template_node)
+        new_node.extend(subset.verts[vert_idx_offset : max_vertex_index + 1])
+        for i in format_face_indexes(facedata, -vert_idx_offset):
+            ET.SubElement(new_node, "Face", {"i": i})
+        new_subset_nodes.append(new_node)
+
+        vert_idx_offset = max_vertex_index + 1
+        tri_idx_start = tri_idx_end + 3
+    return (new_subset_nodes, None)
+
+
+def unpack(subset, orig_lsb_data):
+    if orig_lsb_data is not None:
+        return unpack_lsb(subset, orig_lsb_data)
+    return unpack_xml(subset)
 
 
 if (len(sys.argv) <= 2) or (
@@ -193,20 +256,18 @@ for ls3_filename in sys.argv[2:]:
     print(f".ls3-Datei: {ls3_filename}")
     subsets_by_key = defaultdict(list)
     lsb_offset = 0
-    root = ET.parse(ls3_filename).getroot()
-    landschaft_node = root.find("./Landschaft")
+    tree = ET.parse(ls3_filename, XML_PARSER)
+    landschaft_node = tree.getroot().find("./Landschaft")
     subset_nodes = list(landschaft_node.findall("./SubSet"))
     if not subset_nodes:
         print("Keine Subsets")
         continue
 
     lsb_filename = os.path.splitext(ls3_filename)[0] + ".lsb"
-    try:
-        with open(lsb_filename, "rb") as f:
-            lsb_data = f.read()
+    lsb_data = read_lsb_file(lsb_filename)
+    if lsb_data is not None:
         print(f".lsb-Datei: {lsb_filename}")
-    except FileNotFoundError:
-        lsb_data = None
+    else:
         print("Keine .lsb-Datei")
 
     for subset_node in subset_nodes:
@@ -236,22 +297,22 @@ for ls3_filename in sys.argv[2:]:
             lsb_data
         ), "Größe der .lsb-Datei passt nicht zu .ls3-Datei"
 
-    new_lsb_data = b"" if lsb_data is not None else None
+    new_lsb_data = [] if lsb_data is not None else None
     new_subset_nodes = []
     for subsets in subsets_by_key.values():
         if sys.argv[1] in ("pack", "dry_pack"):
             (packed_subsets, packed_lsb_data) = pack(subsets, lsb_data)
-            new_subset_nodes += packed_subsets
+            new_subset_nodes.extend(packed_subsets)
             if new_lsb_data is not None:
-                new_lsb_data += packed_lsb_data
+                new_lsb_data.extend(packed_lsb_data)
         else:
             for subset in subsets:
                 (unpacked_subsets, unpacked_lsb_data) = unpack(subset, lsb_data)
-                new_subset_nodes += unpacked_subsets
+                new_subset_nodes.extend(unpacked_subsets)
                 if new_lsb_data is not None:
-                    new_lsb_data += unpacked_lsb_data
+                    new_lsb_data.extend(unpacked_lsb_data)
     if new_lsb_data is not None:
-        assert len(new_lsb_data) == sum(
+        assert sum(map(len, new_lsb_data)) == sum(
             40 * int(subset_node.attrib["MeshV"]) + 2 * int(subset_node.attrib["MeshI"])
             for subset_node in new_subset_nodes
         )
@@ -268,9 +329,9 @@ for ls3_filename in sys.argv[2:]:
             ]
 
             with open(ls3_filename + "~", "wb") as f:
-                f.write(ET.tostring(root, encoding="utf-8", xml_declaration=True))
+                tree.write(f, encoding="utf-8", xml_declaration=True)
             if new_lsb_data is not None:
-                with open(lsb_filename + "~", "wb") as f:
-                    f.write(new_lsb_data)
-                os.rename(lsb_filename + "~", lsb_filename)
-            os.rename(ls3_filename + "~", ls3_filename)
+                with open(lsb_filename + "~", "wb", buffering=1 << 20) as f:
+                    f.writelines(new_lsb_data)
+                os.replace(lsb_filename + "~", lsb_filename)
+            os.replace(ls3_filename + "~", ls3_filename)